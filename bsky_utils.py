@@ -1,12 +1,57 @@
 
 import json
+import logging
+import os
 import requests
+from requests.adapters import HTTPAdapter
 from requests.exceptions import HTTPError
+from urllib3.util.retry import Retry
+try:
+    import orjson
+except ImportError:
+    orjson = None
 import re
+import time
 from datetime import datetime, timezone, timedelta
 from pathlib import Path
+from dataclasses import dataclass
 import mimetypes
 import urllib.parse
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_EXCEPTION
+from itertools import islice
+
+_log = logging.getLogger(__name__)
+
+# One pooled session for every request, so repeated calls to the same host reuse connections
+_SESSION = requests.Session()
+_SESSION.mount('https://', HTTPAdapter(
+    pool_connections=32, pool_maxsize=64,
+    max_retries=Retry(total=3, backoff_factor=0.2, status_forcelist=[429, 502, 503, 504],
+                      raise_on_status=False)))
+_SESSION.mount('http://', HTTPAdapter(pool_connections=32, pool_maxsize=64))
+
+# Words that become facets: links and hashtags, matched on UTF-8 bytes so spans are byte offsets
+_FACET_RE = re.compile(r'(?<!\S)(?:https?://|#)\S+')
+_LINK_RE = re.compile(r'^(https?://)([^ \n]+)')
+_TAG_RE = re.compile(r'^#([^ \n]+)')
+
+# Timestamp deltas like "H-2" or "T+7": unit, sign, amount
+_DELTA_RE = re.compile(r"^([A-Za-z]+)([\-\+])(\d+)$")
+_TIME_UNITS = {
+    "MS": timedelta(microseconds=1),
+    "S": timedelta(seconds=1),
+    "H": timedelta(hours=1),
+    "T": timedelta(days=1),
+    "W": timedelta(weeks=1),
+    "M": timedelta(weeks=4),
+    "Y": timedelta(days=365),
+}
+
+# Load the MIME database up front instead of on the first upload_blob call
+mimetypes.init()
+
+# Buffer size for file output, large enough that big dumps cost a handful of write syscalls
+IO_BUFFER_SIZE = 1 << 20
 
 # JSON
 
@@ -34,13 +79,27 @@ def save_json(obj, path=None, prompt=False, indent=4):
     path = validate_path(path, "output", ['json'])
     path = Path(path)
     try:
-        with path.open('w') as file:
+        with path.open('w', encoding='utf-8', buffering=IO_BUFFER_SIZE) as file:
             json.dump(obj, file, indent=indent)
         print(
             f"JSON extracted to \033]8;;file://{path}\033\\'{path}'\033]8;;\033\\")
     except IOError as e:
         print(f"Failed to write JSON to '{path}': {e}")
 
+
+def _dumps(obj):
+    """Serialize a request body to compact JSON bytes, with orjson when it is installed"""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+
+def _loads(data):
+    """Parse a JSON response body, with orjson when it is installed"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
 # UTILS
 
 
@@ -55,35 +114,84 @@ def traverse(obj, *paths, default=None, get_all=False):
             The result of the object traversal. If get_all=True, returns a list.
     """
     results = []
+    # one pass per path: plain keys are a single dict.get, alternatives try each sub-key in turn
     for path in paths:
         current = obj
         for key in path:
             if isinstance(key, list):
-                found = False
                 for sub_key in key:
                     if sub_key is None:
+                        current = None
                         break
                     if isinstance(current, dict) and sub_key in current:
                         current = current[sub_key]
-                        found = True
                         break
-                if not found:
-                    current = None
-                    break
-            else:
-                if isinstance(current, dict) and key in current:
-                    current = current[key]
                 else:
                     current = None
+                if current is None:
                     break
-        if current is not None:
-            if get_all:
-                results.append(current)
+            elif type(current) is dict or isinstance(current, dict):
+                current = current.get(key)
             else:
+                current = None
+                break
+        if current is not None:
+            if not get_all:
                 return current
+            results.append(current)
     return results if results else default
 
 
+_COMPILED_PATHS = {}
+
+
+def compile_traverse(path):
+    """Build a specialized accessor for a fixed path of plain keys, like `['records']` or `['cursor']`.
+        Paths with alternative keys, like `[['records', 'items']]`, fall back to traverse.
+        Accessors are cached per path, so hot loops can compile once and call the result directly.
+        Args:
+            path (list): The keys to walk, in order
+        Returns:
+            accessor (function): Takes a dict and returns the value at `path`, or None if missing
+    """
+    if any(isinstance(key, list) for key in path):
+        # alternative keys can't be compiled (or cached); walk them with traverse instead
+        return lambda obj: traverse(obj, path)
+
+    keys = tuple(path)
+    if (accessor := _COMPILED_PATHS.get(keys)) is not None:
+        return accessor
+
+    if len(keys) == 1:
+        key = keys[0]
+
+        def accessor(obj):
+            return obj.get(key) if isinstance(obj, dict) else None
+    else:
+        def accessor(obj):
+            for key in keys:
+                if not isinstance(obj, dict):
+                    return None
+                obj = obj.get(key)
+            return obj
+
+    _COMPILED_PATHS[keys] = accessor
+    return accessor
+
+
+def batched(iterable, n):
+    """Split an iterable into lists of `n` items, the last possibly shorter. Like itertools.batched (3.12+).
+        Args:
+            iterable: The items to split
+            n (int): Items per batch
+        Returns:
+            A generator of lists
+    """
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, n)):
+        yield batch
+
+
 def safe_request(req_type, url, headers=None, params=None, data=None, json=None, fatal=True):
     """Make a request with error handling, and return JSON
         Args:
@@ -101,31 +209,31 @@ def safe_request(req_type, url, headers=None, params=None, data=None, json=None,
     # TODO: Add error message
     # TODO: Print all parameters when failure to assist debug
     # TODO: REMINDER THAT BOOLS ARE NOT BOOLS: True = "true"
+    method = req_type.upper()
+    if method not in ('GET', 'POST'):
+        if fatal:
+            raise ValueError(f"Not a valid request type: '{req_type}'.")
+        return None
     try:
-        if req_type.upper() == 'GET':
-            response = requests.get(url, headers=headers, params=params)
-        elif req_type.upper() == 'POST':
-            response = requests.post(
-                url, headers=headers, data=data, json=json)
+        if method == 'GET':
+            response = _SESSION.get(url, headers=headers, params=params)
         else:
-            if fatal:
-                Exception(f"Not a valid request type: '{req_type}'.")
-            else:
-                return None
+            response = _SESSION.post(
+                url, headers=headers, data=data, json=json)
         response.raise_for_status()
-    except HTTPError:
-        print(f"Request failed. Status code: {response.status_code}. Response: {response.text}")
+    except HTTPError as e:
+        _log.warning("Request failed. Status code: %s. Response: %s", e.response.status_code, e.response.text)
         if fatal:
             raise
-        print(f"Continuing anyway")
+        _log.warning("Continuing anyway")
         return None
     except Exception as e:
-        print(f"An unexpected error occurred: {e}")
+        _log.warning("An unexpected error occurred: %s", e)
         if fatal:
             raise
-        print(f"Continuing anyway")
+        _log.warning("Continuing anyway")
         return None
-    return response.json()
+    return _loads(response.content)
 
 
 def url_basename(url):
@@ -135,8 +243,12 @@ def url_basename(url):
         Returns:
             basename (str): The final part of a '/' delimited string
     """
-    path = urllib.parse.urlparse(url).path
-    return path.strip('/').split('/')[-1]
+    path = url.partition('?')[0].partition('#')[0]
+    scheme, sep, rest = path.partition('://')
+    if sep and '/' not in scheme:
+        # drop the authority, so a bare host like 'https://bsky.app' has no basename
+        path = rest.partition('/')[2]
+    return path.rstrip('/').rpartition('/')[2]
 
 
 def validate_path(path, fallback_filename, allowed_ext):
@@ -150,34 +262,22 @@ def validate_path(path, fallback_filename, allowed_ext):
             path (str): the corrected path
     """
     if not path:
-        return f"{Path.cwd()}/{fallback_filename}.{allowed_ext[0]}"
+        return os.path.join(os.getcwd(), f"{fallback_filename}.{allowed_ext[0]}")
 
-    path = Path(path)
-
-    if path.is_dir():
-        if not path.exists():
-            path.mkdir(parents=True, exist_ok=True)
-        return f"{path}/{fallback_filename}.{allowed_ext[0]}"
-
-    directory, stem, suffix = path.parent, path.stem, path.suffix
-    if not directory:
-        directory = Path.cwd()
-    elif not directory.exists():
-        path.mkdir(parents=True, exist_ok=True)
+    path = os.fspath(path)
+    if os.path.isdir(path):
+        return os.path.join(path, f"{fallback_filename}.{allowed_ext[0]}")
 
-    stem = str(stem) if stem else fallback_filename
+    directory, filename = os.path.split(path)
+    stem, suffix = os.path.splitext(filename)
+    directory = directory or os.getcwd()
+    os.makedirs(directory, exist_ok=True)
 
-    if suffix:
-        suffix = str(suffix)
-        for ext in allowed_ext:
-            if ext == suffix:
-                break
-        else:
-            suffix = allowed_ext[0]
-    else:
+    suffix = suffix[1:]
+    if suffix not in allowed_ext:
         suffix = allowed_ext[0]
 
-    return f"{directory}/{stem}.{suffix}"
+    return os.path.join(directory, f"{stem or fallback_filename}.{suffix}")
 
 
 def linkify(text, link=None, file=False):
@@ -203,55 +303,142 @@ def get_session(username, password, service_endpoint):
     }
     return safe_request('post', url, json=payload)
 
+
+def auth_headers(session, method='post'):
+    """Return the request headers for a session. They are built once per method and token and kept on the session.
+        Args:
+            session (dict): The session returned by get_session
+            method (str): 'get' for Authorization only, 'post' to also declare a JSON body
+        Returns:
+            headers (dict): The request headers
+    """
+    key = f"_headers_{method.lower()}"
+    authorization = f"Bearer {session.get('accessJwt')}"
+    # rebuild after the accessJwt is refreshed in place
+    if (headers := session.get(key)) is None or headers['Authorization'] != authorization:
+        headers = {'Authorization': authorization}
+        if method.lower() == 'post':
+            headers['Content-Type'] = 'application/json'
+        session[key] = headers
+    return headers
+
 # URL / URI
 
 
-def url2uri(post_url, use_did=True):
-    parts = post_url.rstrip('/').replace("https://", "").split('/')
+@dataclass(frozen=True)
+class AtRef:
+    """A reference to a single record, parsed once from an AT-URI or a bsky.app url
+        Attributes:
+            repo (str): Repository DID, or handle if it was not resolved
+            collection (str): The NSID of the record's lexicon schema.
+            rkey (str): The record key which identifies an individual
+                record within a collection in a given repository.
+    """
+    repo: str
+    collection: str
+    rkey: str
+
+    @property
+    def uri(self):
+        return f"at://{self.repo}/{self.collection}/{self.rkey}"
+
+
+# bsky.app url path segment -> record collection
+_URL_COLLECTIONS = {
+    'post': 'app.bsky.feed.post',
+    'lists': 'app.bsky.graph.list',
+    'feed': 'app.bsky.feed.generator',
+}
+
+
+def parse_ref(ref, use_did=False):
+    """Parse an AT-URI or bsky.app record url into an AtRef
+        Args:
+            ref (str): The AT-URI, or bsky.app post, list or feed url to parse
+            use_did (bool): Resolve a url's handle to a DID
+        Returns:
+            ref (AtRef): The parsed record reference
+    """
+    if not ref.startswith("at://") and (ref.startswith(("https://", "http://")) or "/profile/" in ref):
+        handle, segment, rkey = _split_record_url(ref)
+        if (collection := _URL_COLLECTIONS.get(segment)) is None:
+            raise ValueError(f"URL '{ref}' does not point to a post, list or feed.")
+        return AtRef(resolve_handle(handle) if use_did else handle, collection, rkey)
+    parts = ref.removeprefix("at://").split("/", 3)
+    if len(parts) > 3:
+        raise ValueError(f"AT URI '{ref}' has too many segments.")
+    elif len(parts) < 3:
+        raise ValueError(f"AT URI '{ref}' does not have enough segments.")
+    return AtRef(*parts)
+
+
+def _split_record_url(url):
+    parts = url.rstrip('/').split("://", 1)[-1].split('/', 5)
     if len(parts) > 5:
-        raise ValueError(f"Post URL '{post_url}' has too many segments.")
+        raise ValueError(f"URL '{url}' has too many segments.")
     if len(parts) < 5:
         raise ValueError(
-            f"Post URL '{post_url}' does not have enough segments.")
-    rkey, handle = parts[-1], parts[-3]
+            f"URL '{url}' does not have enough segments.")
+    return parts[-3], parts[-2], parts[-1]
+
+
+def split_post_url(post_url):
+    """Split a post url into its handle and rkey
+        Args:
+            post_url (str): A bsky.app post url
+        Returns:
+            handle (str): The handle or DID in the url
+            rkey (str): The post's record key
+    """
+    handle, segment, rkey = _split_record_url(post_url)
+    if segment != 'post':
+        raise ValueError(f"URL '{post_url}' is not a post url.")
+    return handle, rkey
+
+
+def url2uri(post_url, use_did=True):
+    return parse_ref(post_url, use_did=use_did).uri
+
+
+def url2uri_bulk(urls, use_did=True, max_workers=16):
+    """Convert many post urls to AT-URIs, resolving each distinct handle once, concurrently.
+        Args:
+            urls (list): bsky.app post urls
+            use_did (bool): Use the DID rather than the handle as the URI authority
+            max_workers (int): How many handles to resolve at once
+        Returns:
+            uris (list): AT-URIs, in the same order as `urls`
+    """
+    refs = [parse_ref(url) for url in urls]
     if use_did:
-        return f"at://{resolve_handle(handle)}/app.bsky.feed.post/{rkey}"
-    return f"at://{handle}/app.bsky.feed.post/{rkey}"
+        actors = resolve_handles_bulk((ref.repo for ref in refs), max_workers=max_workers)
+    else:
+        actors = {ref.repo: ref.repo for ref in refs}
+    return [f"at://{actors[ref.repo]}/{ref.collection}/{ref.rkey}" for ref in refs]
 
 
 def uri2url(uri, use_did=False):
-    did, collection, rkey = decompose_uri(uri)
+    ref = parse_ref(uri)
     if use_did:
-        actor = resolve_handle(did)
+        actor = resolve_handle(ref.repo)
     else:
-        actor = retrieve_handle(did)
-    return f"https://bsky.app/profile/{actor}/{collection.split('.')[-1]}/{rkey}"
+        actor = retrieve_handle(ref.repo)
+    return f"https://bsky.app/profile/{actor}/{ref.collection.split('.')[-1]}/{ref.rkey}"
 
 
 def decompose_uri(uri):
     """
         Decompose a uri into its constitutent parts.
         Args:
-            uri (str): The AT-URI to decompose
+            uri (str): The AT-URI or post url to decompose
         Returns:
             repo (str): Repository DID
             collection (str): The NSID of the record's lexicon schema.
             rkey (str): The record key which identifies an individual
                 record within a collection in a given repository.
     """
-    if uri.startswith("http://"):
-        return decompose_url(uri)
-    parts = uri.replace("at://", "").split("/")
-    if len(parts) > 3:
-        raise ValueError(f"AT URI '{uri}' has too many segments.")
-    elif len(parts) < 3:
-        raise ValueError(f"AT URI '{uri}' does not have enough segments.")
-    return *parts,
-    # uri_parts = uri.replace("at://", "").split("/")
-    # repo = uri_parts[0]
-    # collection = uri_parts[1]
-    # rkey = uri_parts[2]
-    # return repo, collection, rkey
+    ref = parse_ref(uri, use_did=True)
+    return ref.repo, ref.collection, ref.rkey
 
 
 def compose_uri(did, rkey, collection="app.bsky.feed.post"):
@@ -266,23 +453,32 @@ def decompose_url(url):
     """
         Decompose a url into its AT-URI constitutent parts.
         Args:
-            uri (str): The post url to decompose
+            url (str): The post url or AT-URI to decompose
         Returns:
             repo (str): Repository DID
             collection (str): The NSID of the record's lexicon schema.
             rkey (str): The record key which identifies an individual
                 record within a collection in a given repository.
     """
-    if post_url.startswith("at://"):
-        return decompose_uri(url)
-    return decompose_uri(url2uri(url))
+    return decompose_uri(url)
 
 # IDENTITY
 
+# Handle -> DID and DID document lookups are stable for the life of a process,
+# so successful results are kept here. Failures are never cached.
+_DID_CACHE = {}
+_DID_DOC_CACHE = {}
+
+
+def clear_identity_cache():
+    """Forget every resolved handle and DID document, e.g. in long-running processes"""
+    _DID_CACHE.clear()
+    _DID_DOC_CACHE.clear()
+
 
 def resolve_handle(handle, fatal=False):
     """
-        Resolve a handle to a DID
+        Resolve a handle to a DID. Results are cached per handle.
         Args:
             handle (str): The handle to resolve
         Returns:
@@ -297,14 +493,51 @@ def resolve_handle(handle, fatal=False):
         handle = handle[1:]
     if not handle:
         return None
-    return (safe_request(
-        'get', f'https://public.api.bsky.app/xrpc/com.atproto.identity.resolveHandle?handle={handle}',
-        fatal=fatal) or {}).get('did')
+    handle = handle.lower()
+    if (did := _DID_CACHE.get(handle)) is None:
+        did = (safe_request(
+            'get', f'https://public.api.bsky.app/xrpc/com.atproto.identity.resolveHandle?handle={handle}',
+            fatal=fatal) or {}).get('did')
+        if did:
+            _DID_CACHE[handle] = did
+    return did
+
+
+def resolve_handles_bulk(handles, max_workers=16):
+    """Resolve many handles to DIDs concurrently. Each distinct handle is looked up once,
+        and results land in the same cache resolve_handle uses.
+        Args:
+            handles (iterable): Handles (or DIDs, which pass through)
+            max_workers (int): How many lookups to have in flight at once
+        Returns:
+            dids (dict): Each given handle mapped to its DID, or None if it could not be resolved
+    """
+    handles = list(dict.fromkeys(handles))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return dict(zip(handles, executor.map(resolve_handle, handles)))
+
+
+def retrieve_handle(did, fatal=False):
+    """
+        Retrieve the handle a DID claims in its DID document
+        Args:
+            did (str): The DID to look up
+        Returns:
+            handle (str): The claimed handle, or the DID itself if none is found
+    """
+    if not did.startswith("did:"):
+        return did[1:] if did.startswith("@") else did
+    for aka in (get_did_doc(did, fatal=fatal) or {}).get('alsoKnownAs') or []:
+        if aka.startswith("at://"):
+            return aka[len("at://"):]
+    if fatal:
+        raise Exception(f"No handle found in DID document for '{did}'.")
+    return did
 
 
 def get_did_doc(did, fatal=False, third_party=False, fallback=False):
     if not did.startswith('did:'):
-        did = retrieve_did(did)
+        did = resolve_handle(did, fatal=fatal)
 
     def retrieve(third_party):
         if third_party:
@@ -313,16 +546,23 @@ def get_did_doc(did, fatal=False, third_party=False, fallback=False):
             return f'https://{did.split(":")[-1]}/.well-known/did.json'
         else:
             return f'https://plc.directory/{did}'
+
+    def fetch(url, fatal):
+        if (response := _DID_DOC_CACHE.get(url)) is None:
+            if (response := safe_request('get', url, fatal=fatal)) is not None:
+                _DID_DOC_CACHE[url] = response
+        return response
+
     url = retrieve(third_party)
     if fallback:
-        if response := safe_request('get', url, fatal=False) is None:
-            return safe_request('get', retrieve(not third_party), fatal=fatal)
+        if (response := fetch(url, fatal=False)) is None:
+            return fetch(retrieve(not third_party), fatal=fatal)
         return response
-    return safe_request('get', url, fatal=fatal)
+    return fetch(url, fatal=fatal)
 
 
 def get_service_endpoint(did, fatal=False, third_party=False, fallback=False):
-    for service in (get_did_doc(did, fatal=fatal, third_party=third_party, fallback=fallback).get('service') or []):
+    for service in ((get_did_doc(did, fatal=fatal, third_party=third_party, fallback=fallback) or {}).get('service') or []):
         if service.get('type') == 'AtprotoPersonalDataServer':
             return service.get('serviceEndpoint')
     if fatal:
@@ -335,23 +575,37 @@ def get_service_endpoint(did, fatal=False, third_party=False, fallback=False):
 # TODO: a way to invoke loop_until_match, yeild_loop, or return_loop for any api - maybe pass function as parameter?
 
 
-def generic_page_loop(api, params, path_to_output, path_to_cursor):
-    res = safe_request('get', api, params=params)
-    output = traverse(res, path_to_output)
-    yield from output
-
-    while cursor := traverse(res, path_to_cursor):
-        res = safe_request('get', api, params={**params, 'cursor': cursor})
-        output = traverse(res, path_to_output)
-        yield from output
-
-
-def generic_page_loop_return(api, params, path_to_output, path_to_cursor):
-    res = safe_request('get', api, params=params)
-    output = traverse(res, path_to_output)
-    while cursor := traverse(res, path_to_cursor):
-        res = safe_request('get', api, params={**params, 'cursor': cursor})
-        output.extend(traverse(res, path_to_output))
+def generic_page_loop(api, params, path_to_output, path_to_cursor, headers=None):
+    get_output = compile_traverse(path_to_output)
+    get_cursor = compile_traverse(path_to_cursor)
+    params = dict(params)
+
+    # fetch the next page in the background while the caller consumes the current one
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        res = safe_request('get', api, headers=headers, params=params)
+        while res is not None:
+            next_page = None
+            if cursor := get_cursor(res):
+                # safe to reuse: the previous request has completed by now
+                params['cursor'] = cursor
+                next_page = executor.submit(
+                    safe_request, 'get', api, headers=headers, params=params)
+            yield from get_output(res) or ()
+            res = next_page.result() if next_page else None
+
+
+def generic_page_loop_return(api, params, path_to_output, path_to_cursor, headers=None):
+    get_output = compile_traverse(path_to_output)
+    get_cursor = compile_traverse(path_to_cursor)
+    params = dict(params)
+
+    # grow the list a page at a time rather than an item at a time
+    res = safe_request('get', api, headers=headers, params=params)
+    output = get_output(res) or []
+    while cursor := get_cursor(res):
+        params['cursor'] = cursor
+        res = safe_request('get', api, headers=headers, params=params)
+        output.extend(get_output(res) or ())
     return output
 
 
@@ -368,21 +622,41 @@ def get_followers_return(actor):
 def get_profile(did, session=None):
     api = 'https://public.api.bsky.app/xrpc/app.bsky.actor.getProfile'
     params = {'actor': did}
-    headers = {"Authorization": "Bearer " +
-               session["accessJwt"]} if session else None
+    headers = auth_headers(session, 'get') if session else None
     return safe_request('get', api, headers=headers, params=params)
 
 
-def list_records(did, service, nsid, ):
+def get_profiles(actors, session=None, max_workers=4):
+    """Retrieve many profiles, 25 per request, with requests issued concurrently.
+        Args:
+            actors (list): Handles or DIDs
+            session (dict): Optional auth session
+            max_workers (int): How many requests to have in flight at once
+        Returns:
+            profiles (list): Profile views. Actors that could not be found are omitted.
+        API:
+            app.bsky.actor.getProfiles
+                public.api.bsky.app
+    """
+    api = 'https://public.api.bsky.app/xrpc/app.bsky.actor.getProfiles'
+    headers = auth_headers(session, 'get') if session else None
+
+    def fetch(chunk):
+        return (safe_request('get', api, headers=headers, params={'actors': chunk}) or {}).get('profiles') or []
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return [profile for profiles in executor.map(fetch, batched(actors, 25)) for profile in profiles]
+
+
+def list_records(did, service, nsid, session=None):
     api = f'{service}/xrpc/com.atproto.repo.listRecords'
     params = {
         'repo': did,
         'collection': nsid,
         'limit': 100,
     }
-    headers = {"Authorization": "Bearer " +
-               session["accessJwt"]} if session else None
-    return generic_page_loop(api, params, ['records'], ['cursor'])
+    headers = auth_headers(session, 'get') if session else None
+    return generic_page_loop(api, params, ['records'], ['cursor'], headers=headers)
 
 
 def get_post_thread(url, depth=0, parent_height=0, fatal=False):
@@ -399,20 +673,29 @@ def get_post_thread(url, depth=0, parent_height=0, fatal=False):
     """
     return (safe_request(
         'get', 'https://public.api.bsky.app/xrpc/app.bsky.feed.getPostThread',
-        headers={'Content-Type': 'application/json'},
         params={
-            'uri': url if url.startswith("at://") else url2uri(url),
+            # the AppView resolves handle-based at-uris itself, so skip the resolveHandle round trip
+            'uri': parse_ref(url).uri,
             'depth': depth,
             'parentHeight': parent_height,
         }, fatal=fatal) or {}).get('thread')
 
 
 def get_post_quotes(at_uri):
+    """Yield every post quoting a post, following the cursor across pages.
+        Args:
+            at_uri (str): url or at-uri of the quoted post
+        Returns:
+            A generator of post views
+        API:
+            app.bsky.feed.getQuotes
+                public.api.bsky.app
+    """
     api = 'https://public.api.bsky.app/xrpc/app.bsky.feed.getQuotes'
     if at_uri.startswith("http"):
         at_uri = url2uri(at_uri)
-    params = {'uri': at_uri}
-    return generic_page_loop(api, 100, ['posts'], ['cursor'], **params)
+    params = {'uri': at_uri, 'limit': 100}
+    return generic_page_loop(api, params, ['posts'], ['cursor'])
 
 # PROFILE
 
@@ -424,31 +707,32 @@ def get_follows(did, service_endpoint):
         "limit": 100,
         "collection": "app.bsky.graph.follow",
     }
-    return list(generic_page_loop(api, params, ['records'], ['cursor']))
+    return generic_page_loop_return(api, params, ['records'], ['cursor'])
 
 # BLOB
 
 
 def upload_blob(session, service_endpoint, blob_location):
     # IMAGE_MIMETYPE = "image/png"
-    mime_type = mimetypes.guess_type(blob_location)
+    mime_type = mimetypes.guess_type(blob_location)[0] or 'application/octet-stream'
     blob_type = mime_type.split('/')[0]
 
-    with open(blob_location, "rb") as f:
-        blob_bytes = f.read()
-
-    if len(blob_bytes) > 1000000:
+    size = Path(blob_location).stat().st_size
+    if size > 1000000:
         raise Exception(
-            f"{blob_type} file size too large. 1000000 bytes maximum, got: {len(blob_bytes)}")
-    safe_request('post',
-                 f"{service_endpoint}/xrpc/com.atproto.repo.uploadBlob",
-                 headers={
-                     "Content-Type": mime_type,
-                     "Authorization": "Bearer " + session["accessJwt"],
-                 },
-                 data=blob_bytes,
-                 )
-    return response.json()["blob"], blob_type
+            f"{blob_type} file size too large. 1000000 bytes maximum, got: {size}")
+
+    # requests streams the open file, so it is never held in memory whole
+    with open(blob_location, "rb") as f:
+        response = safe_request('post',
+                                f"{service_endpoint}/xrpc/com.atproto.repo.uploadBlob",
+                                headers={
+                                    "Authorization": f"Bearer {session.get('accessJwt')}",
+                                    "Content-Type": mime_type,
+                                },
+                                data=f,
+                                )
+    return response["blob"], blob_type
 
 # POST
 
@@ -458,47 +742,59 @@ def hardcode_time(*args, **kwargs):
     return datetime(*args, **kwargs, tzinfo=timezone.utc)
 
 
+def format_timestamp(moment):
+    """Format a datetime as a fixed-width UTC timestamp, e.g. '2024-01-01T00:00:00.000000Z'
+        Args:
+            moment (datetime): The datetime to format. Naive datetimes are taken to be UTC.
+        Returns:
+            timestamp (str): The formatted timestamp
+    """
+    if moment.tzinfo is None:
+        # astimezone would read a naive datetime as local time
+        moment = moment.replace(tzinfo=timezone.utc)
+    moment = moment.astimezone(timezone.utc)
+    return (f"{moment.year:04d}-{moment.month:02d}-{moment.day:02d}T"
+            f"{moment.hour:02d}:{moment.minute:02d}:{moment.second:02d}.{moment.microsecond:06d}Z")
+
+
 def generate_timestamp(delta=None, hardcode=None, fatal=False):
     if hardcode is not None:
-        return hardcode.isoformat().replace("+00:00", "Z")
+        return format_timestamp(hardcode)
         # call hardcode_time first
-    time = datetime.now(timezone.utc)
+    now = datetime.now(timezone.utc)
     if delta is not None:
-        if isinstance(delta, str) and (match := re.match(r"^([A-Za-z]+)([\-\+])(\d+)$", delta)):
+        if isinstance(delta, str) and (match := _DELTA_RE.match(delta)):
             unit = match.group(1).upper()
             value = int(match.group(3))
-            time_units = {
-                "MS": lambda v: timedelta(microseconds=v),
-                "S": lambda v: timedelta(seconds=v),
-                "H": lambda v: timedelta(hours=v),
-                "T": lambda v: timedelta(days=v),
-                "W": lambda v: timedelta(weeks=v),
-                "M": lambda v: timedelta(weeks=4 * v),
-                "Y": lambda v: timedelta(days=365 * v)
-            }
-            if unit in time_units:
-                tdelta = time_units[unit](value)
+            if unit in _TIME_UNITS:
+                tdelta = _TIME_UNITS[unit] * value
                 if match.group(2) == "-":
-                    time = time - tdelta
+                    now = now - tdelta
                 elif match.group(2) == "+":
-                    time = time + tdelta
+                    now = now + tdelta
         elif fatal:
             raise Exception("Invalid delta format")
         else:
             print("Invalid delta format. Returning datetime.now")
-    return time.isoformat().replace("+00:00", "Z")
+    return format_timestamp(now)
 
 
 def add_parent_to_post(post, parent_url):
-    pdata = get_post_thread(parent_url)
+    thread = get_post_thread(parent_url, fatal=True) or {}
+    if 'post' not in thread:
+        # a #notFoundPost or #blockedPost thread has no post to reply to
+        raise ValueError(f"Parent post '{parent_url}' was not found or is blocked.")
+    parent = thread['post']
+    # a parent that is not itself a reply is the root of the thread
+    root = (parent['record'].get('reply') or {}).get('root') or parent
     post['reply'] = {
         "parent": {
-            "cid": pdata.get('post').get('cid'),
-            "uri": pdata.get('post').get('uri'),
+            "cid": parent.get('cid'),
+            "uri": parent.get('uri'),
         },
         "root": {
-            "cid": pdata.get('post').get('record').get('reply').get('root').get('cid'),
-            "uri": pdata.get('post').get('record').get('reply').get('root').get('uri'),
+            "cid": root.get('cid'),
+            "uri": root.get('uri'),
         }
     }
     return post
@@ -546,33 +842,41 @@ def add_facet_to_post(post, link, facet_type, start, end):
 
 
 def is_link(word):
-    if match := re.match(r'^(http(?:s)?://)([^ \n]+)', word):
+    if match := _LINK_RE.match(word):
         link = urllib.parse.quote(match.group(2))
         return f"{match.group(1)}{link}", "uri", f"{link[:27]}..." if len(link) > 30 else None
-    elif match := re.match(r'^#([^ \n]+)', word):
+    elif match := _TAG_RE.match(word):
         return urllib.parse.quote(match.group(1)), "tag", None
     return None, None, None
 
 
 def apply_facets(text, post):
-    current_index = 0
-    for word in re.split(r'\s+', text):
-        link, facet_type, display_link = is_link(word)
+    """Add link and tag facets to a post, shortening long link text.
+        Facet indices are UTF-8 byte offsets into the final text, as the lexicon requires.
+        Args:
+            text (str): The post text
+            post (dict): The post record to add facets to
+        Returns:
+            post (dict): The post, with `text` and `facets` set
+    """
+    # match on str so Unicode whitespace (NBSP, U+3000, ...) still separates words,
+    # and count UTF-8 bytes only for the text between matches
+    output = []
+    byte_offset = 0
+    last = 0
+    for match in _FACET_RE.finditer(text):
+        link, facet_type, display_link = is_link(match.group())
         if not link:
-            current_index += len(word) + 1
             continue
-
-        facet_text = display_link or link
-        start = text.index(word, current_index)
-        end = start + len(facet_text) + (1 if facet_type == "tag" else 0)
-
-        if display_link:
-            text = text[:start] + facet_text + text[start + len(word):]
-            current_index += len(facet_text) - len(word)
-
-        post = add_facet_to_post(post, link, facet_type, start, end)
-        current_index = end + 1
-    post['text'] = text
+        between = text[last:match.start()]
+        shown = display_link or match.group()
+        output += (between, shown)
+        start = byte_offset + len(between.encode('utf-8'))
+        byte_offset = start + len(shown.encode('utf-8'))
+        post = add_facet_to_post(post, link, facet_type, start, byte_offset)
+        last = match.end()
+    output.append(text[last:])
+    post['text'] = ''.join(output)
     return post
 
 
@@ -594,20 +898,14 @@ def create_post(session, service_endpoint, text="", parent_url=None, blob_path=N
     if blob_path:
         add_blob_to_post(post, blob_path, alt_text)
 
-    payload = json.dumps({
+    payload = _dumps({
         "repo": did,
         "collection": "app.bsky.feed.post",
         "validate": True,
         "record": post,
     })
 
-    token = session.get('accessJwt')
-
-    headers = {
-        'Content-Type': 'application/json',
-        'Accept': 'application/json',
-        'Authorization': f'Bearer {token}'
-    }
+    headers = auth_headers(session)
 
     data = safe_request('post', url, headers=headers, data=payload)
     print(
@@ -637,15 +935,10 @@ def create_post_prompt(username=None, password=None, text=None, parent_url=None,
 
 def delete_record(session, service_endpoint, collection, rkey, view_json=True):
     # collection // nsid
-    token = session.get('accessJwt')
     did = session.get('did')
     api = f"{service_endpoint}/xrpc/com.atproto.repo.deleteRecord"
-    headers = {
-        'Content-Type': 'application/json',
-        'Accept': 'application/json',
-        'Authorization': f'Bearer {token}'
-    }
-    payload = json.dumps({
+    headers = auth_headers(session)
+    payload = _dumps({
         "repo": did,
         "collection": collection,
         "rkey": rkey,
@@ -659,16 +952,13 @@ def delete_record(session, service_endpoint, collection, rkey, view_json=True):
 
 
 def delete_post(session, service_endpoint, url, view_json=True):
-    did, _, rkey = decompose_url(url)
+    did, collection, rkey = decompose_url(url)
+    if collection != "app.bsky.feed.post":
+        raise ValueError(f"'{url}' is not a post.")
 
     api = f"{service_endpoint}/xrpc/com.atproto.repo.deleteRecord"
-    token = session.get('accessJwt')
-    headers = {
-        'Content-Type': 'application/json',
-        'Accept': 'application/json',
-        'Authorization': f'Bearer {token}'
-    }
-    payload = json.dumps({
+    headers = auth_headers(session)
+    payload = _dumps({
         "repo": did,
         "collection": "app.bsky.feed.post",
         "rkey": rkey,
@@ -681,6 +971,10 @@ def delete_post(session, service_endpoint, url, view_json=True):
 
 
 def replace_post(session, service_endpoint, url, text, view_json=True):
+    did, collection, rkey = decompose_url(url)
+    if collection != "app.bsky.feed.post":
+        raise ValueError(f"'{url}' is not a post.")
+
     api = f"{service_endpoint}/xrpc/com.atproto.repo.createRecord"
     record = get_post_thread(url)
 
@@ -691,22 +985,14 @@ def replace_post(session, service_endpoint, url, text, view_json=True):
     record["text"] = text
     # remove blobs and facets etc
 
-    did, collection, rkey = decompose_url(url)
-
-    payload = json.dumps({
+    payload = _dumps({
         "repo": did,
         "collection": collection,  # "app.bsky.feed.post",
         "validate": False,
         "rkey": rkey,
         "record": record,
     })
-    token = session.get('accessJwt')
-
-    headers = {
-        'Content-Type': 'application/json',
-        'Accept': 'application/json',
-        'Authorization': f'Bearer {token}'
-    }
+    headers = auth_headers(session)
     response = safe_request('post', api, headers=headers, data=payload)
 
     print(f"Post replaced successfully: https://bsky.app/profile/{session.get('handle')}/post/{rkey}")
@@ -726,6 +1012,105 @@ def replace_post_prompt(username=None, password=None, url=None, text=None):
 
     replace_post(session, service_endpoint, url, text)
 
+# WRITES
+
+_APPLY_WRITES_CREATE = {"$type": "com.atproto.repo.applyWrites#create"}
+
+# Longest rate-limit reset (in seconds) apply_writes will sleep through before giving up
+MAX_RATE_LIMIT_WAIT = 60
+
+
+class ApplyWritesError(Exception):
+    """A chunk of apply_writes_batch failed. `responses` has the applyWrites response
+        of every chunk that was written, and None for the rest, in chunk order.
+    """
+
+    def __init__(self, message, responses):
+        super().__init__(message)
+        self.responses = responses
+
+
+def apply_writes(session, service_endpoint, writes, validate=True):
+    """Apply up to 200 creates, updates and deletes to the session's repo in one request.
+        Args:
+            session (dict): The auth session
+            service_endpoint (str): The PDS to write to
+            writes (list): com.atproto.repo.applyWrites#create/#update/#delete objects
+            validate (bool): Validate records against their lexicons
+        Returns:
+            response (dict): The applyWrites response
+        API:
+            com.atproto.repo.applyWrites
+                user-specified service endpoint
+    """
+    api = f"{service_endpoint}/xrpc/com.atproto.repo.applyWrites"
+    payload = _dumps({
+        "repo": session.get('did'),
+        "validate": validate,
+        "writes": writes,
+    })
+    headers = auth_headers(session)
+    for attempt in range(3):
+        try:
+            return safe_request('post', api, headers=headers, data=payload)
+        except HTTPError as e:
+            # rate limited: wait for the window the PDS reports, then resend the same chunk
+            if e.response is None or e.response.status_code != 429 or attempt == 2:
+                raise
+            reset = e.response.headers.get('ratelimit-reset')
+            wait = max(int(reset) - time.time(), 1) if reset and reset.isdigit() else 2 ** attempt
+            if wait > MAX_RATE_LIMIT_WAIT:
+                # an hourly or daily write limit; don't park the worker that long
+                raise
+            time.sleep(wait)
+
+
+def apply_writes_batch(session, service_endpoint, records, max_workers=4):
+    """Create any number of records through applyWrites, 200 per request, with requests issued concurrently.
+        Args:
+            session (dict): The auth session
+            service_endpoint (str): The PDS to write to
+            records (list): Records to create, keyed by their `$type`.
+                applyWrites write objects are passed through unchanged.
+            max_workers (int): How many requests to have in flight at once
+        Returns:
+            responses (list): The applyWrites response for each chunk, in order
+        Raises:
+            ApplyWritesError: A chunk failed. Chunks not yet sent are cancelled, and
+                the error's `responses` holds what was written (None for unwritten chunks).
+    """
+    writes = (record if record['$type'].startswith('com.atproto.repo.applyWrites#') else {
+        **_APPLY_WRITES_CREATE,
+        "collection": record['$type'],
+        "value": record,
+    } for record in records)
+    futures = []
+
+    def cancel_queued(future):
+        # runs in the failing worker before it can pick up another chunk
+        if not future.cancelled() and future.exception() is not None:
+            for queued in futures:
+                queued.cancel()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for chunk in batched(writes, 200):
+            futures.append(future := executor.submit(apply_writes, session, service_endpoint, chunk))
+            future.add_done_callback(cancel_queued)
+        wait(futures, return_when=FIRST_EXCEPTION)
+        # also catches chunks submitted after the failure; leaving the block waits for those in flight
+        for future in futures:
+            future.cancel()
+
+    responses = [None if future.cancelled() or future.exception() else future.result()
+                 for future in futures]
+    for index, future in enumerate(futures):
+        if not future.cancelled() and (error := future.exception()) is not None:
+            written = sum(response is not None for response in responses)
+            raise ApplyWritesError(
+                f"applyWrites chunk {index} failed; {written} of {len(futures)} chunks were written.",
+                responses) from error
+    return responses
+
 # LISTS
 
 def get_list_items(list_uri, limit=100):
@@ -735,7 +1120,7 @@ def get_list_items(list_uri, limit=100):
     }
     #TODO: endpoint? i don't think it adds anything
     api = 'https://public.api.bsky.app/xrpc/app.bsky.graph.getList'
-    return list(generic_page_loop(api, params, ['items'], ['cursor']))
+    return generic_page_loop_return(api, params, ['items'], ['cursor'])
     
 
 def get_list(list_uri):
@@ -779,13 +1164,7 @@ def get_list_record(session, service_endpoint, selected_list):
         "collection": collection,  # "app.bsky.graph.list",
         "rkey": rkey,
     }
-    token = session.get('accessJwt')
-
-    headers = {
-        'Content-Type': 'application/json',
-        'Accept': 'application/json',
-        'Authorization': f'Bearer {token}'
-    }
+    headers = auth_headers(session, 'get')
 
     data = safe_request('get', url, headers=headers, params=params)
     return data["value"], data["uri"]
@@ -806,9 +1185,9 @@ def create_list(session, service_endpoint, name="", description="", created_at="
     if description == "":
         description = input("Enter new list description: ")
     if created_at == "":
-        created_at = str(datetime.now(timezone.utc).isoformat().replace("+00:00", "Z"))
+        created_at = generate_timestamp()
 
-    payload = json.dumps({
+    payload = _dumps({
         "repo": did,
         "collection": "app.bsky.graph.list",
         "record": {
@@ -819,12 +1198,7 @@ def create_list(session, service_endpoint, name="", description="", created_at="
             "createdAt": created_at
         }
     })
-    token = session.get('accessJwt')
-    headers = {
-        'Content-Type': 'application/json',
-        'Accept': 'application/json',
-        'Authorization': f'Bearer {token}'
-    }
+    headers = auth_headers(session)
     _, _, rkey = decompose_uri(
         (safe_request('post', url, headers=headers, data=payload) or {}).get('uri'))
     if rkey:
@@ -847,19 +1221,14 @@ def update_list_metadata(session, service_endpoint, selected_list, name=None, de
     did, collection, rkey = decompose_uri(uri)
     url = f"{service_endpoint}/xrpc/com.atproto.repo.putRecord"
 
-    payload = json.dumps({
+    payload = _dumps({
         "repo": did,
         "collection": collection,  # "app.bsky.graph.list",
         "rkey": rkey,
         "record": record,
     })
 
-    token = session.get('accessJwt')
-    headers = {
-        'Content-Type': 'application/json',
-        'Accept': 'application/json',
-        'Authorization': f'Bearer {token}'
-    }
+    headers = auth_headers(session)
 
     data = safe_request('post', url, headers=headers, data=payload)
     _, _, rkey = decompose_uri(data.get('uri'))
@@ -912,66 +1281,59 @@ def delete_list(session, service_endpoint, selected_list):
     did, collection, rkey = decompose_uri(uri)
     url = f"{service_endpoint}/xrpc/com.atproto.repo.deleteRecord"
 
-    payload = json.dumps({
+    payload = _dumps({
         "repo": did,
         "collection": collection,
         "rkey": rkey,
     })
 
-    token = session.get('accessJwt')
-
-    headers = {
-        'Content-Type': 'application/json',
-        'Accept': 'application/json',
-        'Authorization': f'Bearer {token}'
-    }
+    headers = auth_headers(session)
 
     safe_request('post', url, headers=headers, data=payload)
     print(f"List successfully created: https://bsky.app/profile/{session.get('handle') or did}/lists/{rkey}")
 
 
-def add_user_to_list(session, service_endpoint, selected_list, user_did):
+def add_user_to_list(session, service_endpoint, selected_list, user_did, created_at=None):
     # createRecord
+    # pass created_at to stamp many adds with one timestamp
     list_uri = selected_list['uri']
     did, collection, rkey = decompose_uri(list_uri)
     url = f"{service_endpoint}/xrpc/com.atproto.repo.createRecord"
 
-    payload = json.dumps({
+    payload = _dumps({
         "repo": did,
         "collection": 'app.bsky.graph.listitem',
         "record": {
             "$type": 'app.bsky.graph.listitem',
             "subject": user_did,
             "list": list_uri,
-            "createdAt": datetime.now(timezone.utc).isoformat().replace("+00:00", "Z"),
+            "createdAt": created_at or generate_timestamp(),
         }
     })
 
-    token = session.get('accessJwt')
-
-    headers = {
-        'Content-Type': 'application/json',
-        'Accept': 'application/json',
-        'Authorization': f'Bearer {token}'
-    }
+    headers = auth_headers(session)
 
     response = safe_request('post', url, headers=headers, data=payload)
     name = selected_list["name"]
     print(f"{user_did} successfully added to list '{name}'")
 
 
-def add_follows_to_list(session, timestamp=True):
+def add_follows_to_list(session, timestamp=True, max_workers=4):
     handle = session['handle']
     selected_list = cli_list_menu(handle)
 
     did = session['did']
     service_endpoint = get_service_endpoint(did)
 
-    for follower in get_follows(did):
-        add_user_to_list(session, service_endpoint,
-                         selected_list, follower['value']['subject'])
+    created_at = generate_timestamp()
+    apply_writes_batch(session, service_endpoint, [{
+        "$type": 'app.bsky.graph.listitem',
+        "subject": follow['value']['subject'],
+        "list": selected_list['uri'],
+        "createdAt": created_at,
+    } for follow in get_follows(did, service_endpoint)], max_workers=max_workers)
 
-    last_update = datetime.now(timezone.utc).isoformat().replace("+00:00", "Z")
+    last_update = generate_timestamp()
 
     if timestamp:
         update_list_metadata(
@@ -987,18 +1349,17 @@ def add_follows_to_list(session, timestamp=True):
 ## ========== ##
 
 def get_follows_since(did, service_endpoint, timestamp):
-    follows = get_follows(did, service_endpoint)
-    # consider from dateutil.parser import parse
-    # save_json(follows)
     since = datetime.fromisoformat(timestamp.replace("Z", "+00:00"))
-    follows_since = []
-    for follow in follows:
-        follow_timestamp = datetime.fromisoformat(follow.get('value').get('createdAt').replace("Z", "+00:00"))
-        if follow_timestamp > since:
-            # print(follow.get('value').get('subject'))
-            follows_since.append(follow.get('value').get('subject'))
-    return follows_since
+    since_seconds = format_timestamp(since)[:19]
+
+    def is_after(created_at):
+        # UTC timestamps order as plain strings down to the second; only same-second ties need parsing
+        if created_at.endswith("Z") and created_at[10:11] == "T" and created_at[:19] != since_seconds:
+            return created_at[:19] > since_seconds
+        return datetime.fromisoformat(created_at.replace("Z", "+00:00")) > since
 
+    return [follow['value']['subject'] for follow in get_follows(did, service_endpoint)
+            if is_after(follow['value']['createdAt'])]
 
 
 def remove_user_from_list():